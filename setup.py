@@ -8,6 +8,9 @@ setup(name='spellcaster',
       author_email='tommyx058@gmail.com',
       license='MIT',
       packages=['spellcaster'],
+      extras_require={
+          'fast': ['orjson', 'ujson', 'msgspec', 'xxhash'],
+      },
       entry_points={
           'console_scripts': [
               'spellcaster = spellcaster.main:main',
@@ -1,7 +1,15 @@
+import asyncio
+import concurrent.futures
+import functools
 import glob
-import json
+import heapq
 import os
 import platform
+import queue
+import selectors
+import shlex
+import signal
+import stat
 import subprocess
 import sys
 import tempfile
@@ -10,10 +18,27 @@ import time
 
 from argparse import ArgumentParser
 from enum import Enum
-from spellcaster.util import RepeatedTimer, get_traceback
+from spellcaster.util import get_traceback, hash_bytes, json_dumps, \
+    json_loads, read_bounded, steady_time
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
 
 SPELL_CONFIG_SUFFIX = '.spell.json'
 SPELL_STATE_SUFFIX = '.spell_state.json'
+STATE_FLUSH_INTERVAL = 1  # seconds
+STOP_TIMEOUT = 3  # seconds
+MAX_STDERR_BYTES = 64 * 1024
+STDIN_READ_SIZE = 64 * 1024
+RECURSIVE_SPELL_PATTERN = '**/*' + SPELL_CONFIG_SUFFIX
+DIRECTORY_CACHE_MIN_AGE_NS = 2 * 10**9
+GLOB_MAGIC_CHARS = frozenset('*?[')
+SHELL_SYNTAX_CHARS = frozenset('|&;<>()$`*?[]{}~!#\n')
+OS_TYPE = platform.system()
+TERMINAL_SCRIPT_TEMPLATE = \
+    b'#!/bin/bash\ncd "%s"\n%s\nread -p "Press ENTER to continue"\n'
 
 
 def get_default_spell_state_path(config_path):
@@ -23,14 +48,176 @@ def get_default_spell_state_path(config_path):
     return None
 
 
-class SpellState(object):
+@functools.lru_cache(maxsize=None)
+def normalize_path(path, cwd):
+    '''
+    Expand "~" in path and join it onto cwd.
+
+    Memoized, since every pattern and state path goes through here on every
+    config load.
+    '''
+    return os.path.join(cwd, os.path.expanduser(path))
+
+
+def get_recursive_spell_root(pattern):
+    '''
+    Return the directory of a "<dir>/**/*.spell.json" pattern, or None if
+    the pattern has any other shape.
+    '''
+    if pattern == RECURSIVE_SPELL_PATTERN:
+        return ''
+
+    if not pattern.endswith('/' + RECURSIVE_SPELL_PATTERN):
+        return None
+
+    root = pattern[:-len(RECURSIVE_SPELL_PATTERN) - 1]
+    if GLOB_MAGIC_CHARS.intersection(root):
+        return None
+
+    return root
+
+
+def list_spell_directory(directory, directory_cache):
+    '''
+    Return (spell_paths, subdirectories) directly inside directory, both as
+    real paths. Hidden entries are skipped like glob does.
+
+    The listing is cached by the directory's mtime, which changes whenever
+    an entry is added, removed or renamed, so unchanged directories cost a
+    single stat.
+    '''
+    mtime = os.stat(directory).st_mtime_ns
+    cached = directory_cache.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    spell_paths = []
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+
+            elif not entry.is_symlink():
+                if entry.name.endswith(SPELL_CONFIG_SUFFIX) and \
+                        entry.is_file(follow_symlinks=False):
+                    spell_paths.append(entry.path)
+
+            # Only symlinks need resolving, and they also need a stat.
+            elif entry.is_dir():
+                subdirectories.append(os.path.realpath(entry.path))
+
+            elif entry.name.endswith(SPELL_CONFIG_SUFFIX) and \
+                    entry.is_file():
+                spell_paths.append(os.path.realpath(entry.path))
+
+    # A listing taken in the same mtime tick as a later change would never
+    # be refreshed, so recently modified directories are not cached.
+    if time.time_ns() - mtime > DIRECTORY_CACHE_MIN_AGE_NS:
+        directory_cache[directory] = (mtime, spell_paths, subdirectories)
+
+    return spell_paths, subdirectories
+
+
+def iter_spell_files(root, directory_cache=None, visited=None):
+    '''
+    Yield the real path of every spell file under root, matching what
+    glob would return for "<root>/**/*.spell.json".
+
+    root must be a real path. Directories already in visited are skipped,
+    which also guards against symlink loops.
+    '''
+    if directory_cache is None:
+        directory_cache = {}
+
+    if visited is None:
+        visited = set()
+
+    if root in visited:
+        return
+
+    visited.add(root)
+    try:
+        spell_paths, subdirectories = list_spell_directory(
+            root, directory_cache)
+
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+    yield from spell_paths
+    for subdirectory in subdirectories:
+        yield from iter_spell_files(subdirectory, directory_cache, visited)
+
+
+@functools.lru_cache(maxsize=256)
+def expand_spell_glob(pattern, directory_mtime):
+    '''
+    Return the real paths matching a glob pattern whose magic is confined
+    to its last component. directory_mtime only serves as the cache key.
+    '''
+    return tuple(
+        os.path.realpath(spell_path) for spell_path in glob.glob(pattern))
+
+
+if msgspec is not None:
+    class SpellStateRecord(msgspec.Struct):
+        '''
+        Schema of a spell state file, decoded and validated natively.
+        '''
+        last_success: float = 0
+
+    SPELL_STATE_DECODER = msgspec.json.Decoder(SpellStateRecord)
+
+
+def decode_spell_state(data):
+    '''
+    Return the last_success time stored in a spell state file's contents.
+    '''
+    if msgspec is not None:
+        return SPELL_STATE_DECODER.decode(data).last_success
+
+    return json_loads(data).get('last_success', 0)
+
+
+# One lock per state file path, so that states sharing a path never write
+# the same temporary file at once. threading.Lock can't be weakly referenced,
+# so the locks are simply kept; there is one per spell at most.
+STATE_FILE_LOCKS = {}
 
-    def __init__(self, state_path, config=None):
-        if config is None:
-            config = {}
 
+def get_state_file_lock(path):
+    lock = STATE_FILE_LOCKS.get(path)
+    if lock is None:
+        lock = STATE_FILE_LOCKS.setdefault(path, threading.Lock())
+
+    return lock
+
+
+class SpellState:
+
+    __slots__ = ('path', 'last_success', 'last_success_mono', 'dirty')
+
+    def __init__(self, state_path, last_success=0):
         self.path = state_path
-        self.last_success = config.get('last_success', 0)
+        self.last_success = None
+        self.last_success_mono = None
+        self.set_last_success(last_success)
+        self.dirty = False
+
+    def set_last_success(self, last_success):
+        # last_success is a wall clock time so that it can be persisted, but
+        # intervals are measured on the steady clock so that wall clock
+        # adjustments don't cause spurious runs, while time spent suspended
+        # still counts.
+        self.last_success = last_success
+        self.last_success_mono = steady_time() - \
+            (time.time() - last_success)
+
+    def get_time_since_success(self):
+        return steady_time() - self.last_success_mono
 
     def to_json(self):
         return {
@@ -38,11 +225,48 @@ class SpellState(object):
         }
 
     def save(self):
-        with open(self.path, 'w') as f:
-            json.dump(self.to_json(), f, indent=2)
+        # Writes are batched, see Caster.flush_states.
+        self.dirty = True
+
+    def flush(self):
+        # Written with a single unbuffered write and synced, then renamed
+        # into place, so the file is never seen half written.
+        data = memoryview(
+            json_dumps(self.to_json(), indent=True, newline=True))
+        tmp_path = self.path + '.tmp'
+        with get_state_file_lock(self.path):
+            fd = os.open(
+                tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+
+                os.fsync(fd)
+
+            finally:
+                os.close(fd)
+
+            os.replace(tmp_path, self.path)
 
 
-class AutoCommandConfig(object):
+def read_spell_state(state_path):
+    # A single stat covers both the existence and the file type checks.
+    try:
+        stat_result = os.stat(state_path)
+
+    except FileNotFoundError:
+        return SpellState(state_path)
+
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise ValueError('{} is not a file'.format(state_path))
+
+    with open(state_path, 'rb') as state_file:
+        return SpellState(state_path, decode_spell_state(state_file.read()))
+
+
+class AutoCommandConfig:
+
+    __slots__ = ('command', 'argv', 'interval', 'unit', 'interval_seconds')
 
     UNIT_TO_SECONDS = {
         'hour': 3600,
@@ -52,11 +276,34 @@ class AutoCommandConfig(object):
         'week': 604800,
     }
 
-    def __init__(self, config):
-        self.command = config.get('command', None)
+    def __init__(self, config, cwd, default_command=None):
+        self.command = config.get('command', default_command)
         if self.command is None:
             raise ValueError('No command specified for auto command')
 
+        # Commands given as a list, or as a string without any shell syntax,
+        # are executed directly rather than through /bin/sh. A string naming
+        # an existing file is run as that program, even if the path has
+        # spaces in it.
+        self.argv = None
+        if not isinstance(self.command, str):
+            self.argv = list(self.command)
+
+        elif os.path.exists(os.path.join(cwd, self.command)):
+            self.argv = [self.command]
+
+        elif not SHELL_SYNTAX_CHARS.intersection(self.command):
+            # Strings shlex can't split, such as ones with unbalanced quotes,
+            # are left to the shell to report when the spell runs.
+            try:
+                argv = shlex.split(self.command)
+
+            except ValueError:
+                argv = None
+
+            if argv and '=' not in argv[0]:
+                self.argv = argv
+
         self.interval = config.get('interval', 1)
         self.unit = config.get('unit', 'hour')
         if self.unit not in AutoCommandConfig.UNIT_TO_SECONDS:
@@ -66,7 +313,10 @@ class AutoCommandConfig(object):
         self.interval_seconds = self.interval * unit_to_seconds
 
 
-class SpellConfig(object):
+class SpellConfig:
+
+    __slots__ = ('config_path', 'cwd', 'name', 'command', 'state_path',
+                 'auto_command')
 
     def __init__(self, config_path, config):
         self.config_path = config_path
@@ -80,50 +330,128 @@ class SpellConfig(object):
         if self.command is None:
             raise ValueError('Spell "{}" has no command'.format(self.name))
 
-        self.state_path = config.get(
-            'state_path', os.path.abspath(
-                get_default_spell_state_path(config_path)))
+        self.state_path = config.get('state_path', None)
+        if self.state_path is None:
+            self.state_path = get_default_spell_state_path(config_path)
+
         if self.state_path is None:
             raise ValueError(
                 'Spell "{}" has no state path given and cannot be deduced from spell path'.format(self.name))
 
-        self.state_path = os.path.join(
-            self.cwd, os.path.expanduser(self.state_path))
+        self.state_path = normalize_path(self.state_path, self.cwd)
 
+        # Without its own command, the auto command runs the spell's.
         self.auto_command = AutoCommandConfig(
-            config.get('auto_command', {}))
-
-        self.spell_state = None
-        self.read_state()
+            config.get('auto_command', {}), self.cwd,
+            default_command=self.command)
 
-    def read_state(self):
-        if os.path.exists(self.state_path):
-            if not os.path.isfile(self.state_path):
-                raise ValueError('{} is not a file'.format(self.state_path))
 
-            with open(self.state_path, 'r') as state_file:
-                self.spell_state = SpellState(
-                    self.state_path, json.load(state_file))
+class CasterConfig:
 
-        else:
-            self.spell_state = SpellState(self.state_path)
+    __slots__ = ('spell_config_cache', 'directory_cache', 'spell_configs')
 
+    def __init__(self, config_path, config, spell_config_cache=None,
+                 directory_cache=None):
+        if spell_config_cache is None:
+            spell_config_cache = {}
 
-class CasterConfig(object):
+        if directory_cache is None:
+            directory_cache = {}
 
-    def __init__(self, config_path, config):
+        # Maps spell path to ((mtime_ns, size), content hash, SpellConfig),
+        # shared across reloads so that unchanged spell files are not parsed
+        # again. The hash catches files rewritten with the same content.
+        self.spell_config_cache = spell_config_cache
+        # Maps directory path to (mtime_ns, spell paths, subdirectories),
+        # see list_spell_directory.
+        self.directory_cache = directory_cache
         self.spell_configs = {}
         paths = config.get('spells', [])
         cwd = os.path.dirname(config_path)
+        visited = set()
         for pattern in paths:
-            spell_paths = glob.glob(
-                os.path.join(cwd, os.path.expanduser(pattern)), recursive=True)
-            for spell_path in spell_paths:
-                self.read_file(os.path.realpath(spell_path))
+            for spell_path in self.expand_pattern(pattern, cwd, visited):
+                self.read_file(spell_path)
+
+        for path in list(self.spell_config_cache.keys()):
+            if path not in self.spell_configs:
+                del self.spell_config_cache[path]
+
+        for path in list(self.directory_cache.keys()):
+            if path not in visited:
+                del self.directory_cache[path]
+
+    def expand_pattern(self, pattern, cwd, visited):
+        root = get_recursive_spell_root(pattern)
+        if root is not None:
+            return iter_spell_files(
+                os.path.realpath(normalize_path(root, cwd)),
+                self.directory_cache, visited)
+
+        pattern = normalize_path(pattern, cwd)
+        directory = os.path.dirname(pattern)
+        if '**' not in pattern and \
+                not GLOB_MAGIC_CHARS.intersection(directory):
+            try:
+                directory_mtime = os.stat(directory).st_mtime_ns
+
+            except (FileNotFoundError, NotADirectoryError):
+                return ()
+
+            if time.time_ns() - directory_mtime > DIRECTORY_CACHE_MIN_AGE_NS:
+                return expand_spell_glob(pattern, directory_mtime)
+
+        return (
+            os.path.realpath(spell_path)
+            for spell_path in glob.glob(pattern, recursive=True))
 
     def read_file(self, path):
-        with open(path, 'r') as f:
-            self.spell_configs[path] = SpellConfig(path, json.load(f))
+        stat_result = os.stat(path)
+        signature = (stat_result.st_mtime_ns, stat_result.st_size)
+        cached = self.spell_config_cache.get(path)
+        if cached is not None and cached[0] == signature:
+            self.spell_configs[path] = cached[2]
+            return
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        content_hash = hash_bytes(data)
+        if cached is not None and cached[1] == content_hash:
+            spell_config = cached[2]
+
+        else:
+            spell_config = SpellConfig(path, json_loads(data))
+
+        self.spell_config_cache[path] = (signature, content_hash, spell_config)
+        self.spell_configs[path] = spell_config
+
+
+def run_in_darwin_terminal(cwd, command):
+    # mkstemp creates the file atomically under a unique name, so concurrent
+    # casts can't collide and no lock is needed.
+    fd, script_path = tempfile.mkstemp(suffix='.sh')
+    try:
+        os.write(fd, TERMINAL_SCRIPT_TEMPLATE % (
+            cwd.encode('utf-8'), command.encode('utf-8')))
+
+    finally:
+        os.close(fd)
+
+    os.chmod(script_path, 0o755)
+    subprocess.run(['open', '-a', 'Terminal.app', script_path], check=True)
+
+
+def run_in_unsupported_terminal(cwd, command):
+    # TODO: implement more OS
+    raise RuntimeError(
+        'The operating system {} is not supported yet'.format(OS_TYPE))
+
+
+# The OS can't change while running, so the implementation is picked once.
+RUN_IN_TERMINAL = {
+    'Darwin': run_in_darwin_terminal,
+}.get(OS_TYPE, run_in_unsupported_terminal)
 
 
 class SpellStatus(Enum):
@@ -134,33 +462,45 @@ class SpellStatus(Enum):
     ERROR = 'error'
 
 
-class Spell(object):
+# Enum members are singletons, so statuses are compared by identity.
+FINISHED_STATUSES = frozenset({SpellStatus.SUCCESS, SpellStatus.WARNING})
+
+
+class Spell:
+
+    __slots__ = ('config', 'caster', 'interval_seconds', 'state', 'future',
+                 'due_time', 'process', 'status', 'message')
 
     def __init__(self, config, caster):
         self.config = config
         self.caster = caster
-        self.thread = None
+        # Cached from the config, as it is read on every due check.
+        self.interval_seconds = config.auto_command.interval_seconds
+        # The state is owned here rather than by the config, so that
+        # reloading a spell file doesn't read its state file again. It is
+        # read on first use, see get_state.
+        self.state = None
+        self.future = None
+        # Due time of this spell's live entry in the caster's due heap.
+        self.due_time = None
         self.process = None
         self.status = None
         self.message = None
         self.change_status(SpellStatus.STANDBY)
 
+    # Reading a single attribute is atomic, so the predicates don't lock.
     def is_standby(self):
-        with self.caster.lock_status():
-            return self.status == SpellStatus.STANDBY
+        return self.status is SpellStatus.STANDBY
 
     def is_running(self):
-        with self.caster.lock_status():
-            return self.status == SpellStatus.RUNNING
+        return self.status is SpellStatus.RUNNING
 
     def is_finished(self):
-        with self.caster.lock_status():
-            return self.status == SpellStatus.SUCCESS or \
-                self.status == SpellStatus.WARNING
+        return self.status in FINISHED_STATUSES
 
     def change_status(self, status, message=None):
         with self.caster.lock_status():
-            if self.status == status:
+            if self.status is status:
                 return
 
             self.status = status
@@ -168,122 +508,211 @@ class Spell(object):
 
         self.caster.notify_update(self)
 
+    def get_state(self):
+        if self.state is None:
+            # Sentinel threads may get here at the same time as the caster.
+            with self.caster.lock_status():
+                if self.state is None:
+                    self.state = read_spell_state(self.config.state_path)
+
+        return self.state
+
+    def is_pending(self):
+        # A submitted run may still be queued, waiting for a free worker.
+        return self.future is not None and not self.future.done()
+
+    def get_due_time(self):
+        return self.get_state().last_success_mono + self.interval_seconds
+
     def update(self, force_run=False):
+        if self.is_pending():
+            return
+
         if not self.is_running() and (
                 force_run or
-                (time.time() - self.config.spell_state.last_success) >=
-                self.config.auto_command.interval_seconds):
-            self.thread = threading.Thread(target=self.sentinel)
-            self.thread.start()
+                self.get_state().get_time_since_success() >=
+                self.interval_seconds):
+            self.future = asyncio.run_coroutine_threadsafe(
+                self.sentinel(), self.caster.loop)
+            self.future.add_done_callback(self.on_run_done)
 
-    def run_in_external_terminal(self):
-        os_type = platform.system()
-
-        if os_type == 'Darwin':
-            with self.caster.lock_tmp_write():
-                FILE_TEMPLATE = '#!/bin/bash\ncd "{}"\n{}\nread -p "Press ENTER to continue"\n'
-                TEMP_FILE = tempfile.NamedTemporaryFile().name
-                with open(TEMP_FILE, 'w') as f:
-                    f.write(FILE_TEMPLATE.format(
-                        self.config.cwd, self.config.command))
-                    os.system('chmod +x "{}"'.format(TEMP_FILE))
-                    os.system('open -a Terminal.app "{}"'.format(TEMP_FILE))
+    def on_run_done(self, future):
+        self.caster.schedule_spell(self)
 
-        else:
-            # TODO: implement more OS
-            raise RuntimeError(
-                'The operating system {} is not supported yet'.format(os_type))
+    def run_in_external_terminal(self):
+        RUN_IN_TERMINAL(self.config.cwd, self.config.command)
 
     def kill(self):
-        if self.process is not None:
-            self.process.kill()
+        process = self.process
+        if process is not None:
+            # Once reaped, its pid and group may already belong to another
+            # process.
+            if process.returncode is not None:
+                return
+
+            # The process leads its own session, so killing the group also
+            # takes down anything it started, such as a shell's children.
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+
+            except ProcessLookupError:
+                pass
 
         else:
             raise RuntimeError('Process is not running')
 
-    def sentinel(self):
+    async def sentinel(self):
+        # Runs on the caster's event loop. The semaphore bounds how many
+        # spells run at once.
+        async with self.caster.get_run_semaphore():
+            # Runs still queued when the caster stops are dropped.
+            if not self.caster.stopping:
+                await self.run_auto_command()
+
+    async def run_auto_command(self):
         if self.is_running():
             return
 
         self.change_status(SpellStatus.RUNNING, "")
 
         try:
-            self.process = subprocess.Popen(
-                self.config.auto_command.command,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                cwd=self.config.cwd)
+            # The process is detached from the caster's stdin, which carries
+            # requests, and only stderr is piped back.
+            auto_command = self.config.auto_command
+            if auto_command.argv is None:
+                self.process = await asyncio.create_subprocess_shell(
+                    auto_command.command,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                    cwd=self.config.cwd,
+                    start_new_session=True)
 
-            stdout, stderr = self.process.communicate()
-            self.process.wait()
+            else:
+                self.process = await asyncio.create_subprocess_exec(
+                    *auto_command.argv,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                    cwd=self.config.cwd,
+                    start_new_session=True)
+
+            # Only the (truncated) stderr is kept, the rest is drained so
+            # that the process never blocks on a full pipe.
+            stderr = await read_bounded(self.process.stderr, MAX_STDERR_BYTES)
+            await self.process.wait()
 
             process = self.process
             self.process = None
 
             # # TODO
-            # self.caster.print(stdout.decode('utf-8'))
             # self.caster.print(stderr.decode('utf-8'))
-            if stderr is not None:
-                stderr = stderr.decode('utf-8').strip()
+            # Stripped as bytes, and only decoded when it becomes a message.
+            stderr = stderr.strip()
 
+            state = self.get_state()
             if process.returncode == 0:
-                if stderr is not None and stderr != '':
-                    self.change_status(SpellStatus.WARNING, stderr)
-                    self.config.spell_state.last_success = 0
-                    self.config.spell_state.save()
+                if stderr:
+                    self.change_status(
+                        SpellStatus.WARNING,
+                        stderr.decode('utf-8', errors='replace'))
+                    state.set_last_success(0)
+                    state.save()
                 else:
                     self.change_status(SpellStatus.SUCCESS, "")
-                    self.config.spell_state.last_success = time.time()
-                    self.config.spell_state.save()
+                    state.set_last_success(time.time())
+                    state.save()
 
             else:
-                self.change_status(SpellStatus.ERROR, stderr)
-                self.config.spell_state.last_success = 0
-                self.config.spell_state.save()
+                self.change_status(
+                    SpellStatus.ERROR,
+                    stderr.decode('utf-8', errors='replace'))
+                state.set_last_success(0)
+                state.save()
 
         except Exception as error:
             self.change_status(SpellStatus.ERROR, str(error))
-            raise error
+            # Exceptions raised here would only be stored in the future.
+            self.caster.print_error()
 
     def set_config(self, config):
-        self.config = config
-
+        old_config = self.config
+        if config.state_path != old_config.state_path:
+            if self.state is not None and self.state.dirty:
+                self.state.flush()
 
-class Caster(object):
+            self.state = None
 
-    class AcquireLock(object):
-        def __init__(self, caster, lock):
-            self.caster = caster
-            self.lock = lock
+        self.config = config
+        interval_seconds = config.auto_command.interval_seconds
+        if config.state_path != old_config.state_path or \
+                interval_seconds != self.interval_seconds:
+            self.interval_seconds = interval_seconds
+            self.caster.schedule_spell(self)
 
-        def __enter__(self):
-            self.lock.acquire()
 
-        def __exit__(self, type, value, traceback):
-            self.lock.release()
+class Caster:
 
     def __init__(self,
                  config_path,
                  update_interval):
-        self.print_lock = threading.Lock()
         self.status_lock = threading.Lock()
-        self.tmp_write_lock = threading.Lock()
         self.config_path = os.path.abspath(config_path)
         self.caster_dir = os.path.dirname(config_path)
         self.caster_config = None
+        # Parsed root config, reused while the file's (mtime_ns, size)
+        # signature or content hash is unchanged.
+        self.config_signature = None
+        self.config_hash = None
+        self.root_config = None
+        self.spell_config_cache = {}
+        self.directory_cache = {}
         self.spells = {}
-        self.timer = RepeatedTimer(
-            update_interval * 60,
-            self.update
-        )
+        # Min-heap of (due_time, spell_id). Entries are invalidated lazily:
+        # only the one matching Spell.due_time is live.
+        self.due_heap = []
+        self.due_lock = threading.Lock()
+        # Spells run as coroutines on one event loop in its own thread,
+        # rather than each blocking a thread while its process runs.
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        # Spells mostly wait on their processes, so allow more of them than
+        # there are CPUs.
+        self.max_running_spells = min(32, (os.cpu_count() or 4) * 2)
+        self.run_semaphore = None
+        self.stopping = False
+        self.update_interval = update_interval * 60
+        # Messages are written by a single thread, so printing never blocks
+        # the caller on stdout.
+        self.print_queue = queue.Queue()
+        self.print_thread = threading.Thread(
+            target=self.print_worker, daemon=True)
+        self.print_thread.start()
 
     def get_caster_dir(self):
         return self.caster_dir
 
     def read_config(self):
-        with open(self.config_path, 'r') as config_file:
-            self.caster_config = CasterConfig(
-                self.config_path, json.load(config_file))
+        stat_result = os.stat(self.config_path)
+        signature = (stat_result.st_mtime_ns, stat_result.st_size)
+        if signature != self.config_signature:
+            with open(self.config_path, 'rb') as config_file:
+                data = config_file.read()
+
+            content_hash = hash_bytes(data)
+            if content_hash != self.config_hash:
+                self.root_config = json_loads(data)
+                self.config_hash = content_hash
+
+            self.config_signature = signature
+
+        # Still rebuilt every time, as spell files may have been added or
+        # removed even though the root config is unchanged.
+        self.caster_config = CasterConfig(
+            self.config_path, self.root_config,
+            self.spell_config_cache, self.directory_cache)
 
     def rerun_spell(self, spell_id):
         if spell_id in self.spells:
@@ -313,57 +742,131 @@ class Caster(object):
             raise ValueError('Spell "{}" not found'.format(spell_id))
 
     def notify_update(self, spell):
-        self.print('@update: {}'.format(
-            json.dumps({
-                'spell_path': spell.config.config_path,
-                'spell_name': spell.config.name,
-                'status': spell.status.value,
-                'message': spell.message,
-            })))
-        sys.stdout.flush()
-
-    def lock_tmp_write(self):
-        return Caster.AcquireLock(self, self.tmp_write_lock)
-
+        # Serialized later by the printer thread, along with its batch.
+        self.print_queue.put({
+            'spell_path': spell.config.config_path,
+            'spell_name': spell.config.name,
+            'status': spell.status.value,
+            'message': spell.message,
+        })
+
+    # Locks are context managers already, so they are returned as is.
     def lock_status(self):
-        return Caster.AcquireLock(self, self.status_lock)
+        return self.status_lock
+
+    def flush_states(self):
+        with self.lock_status():
+            states = []
+            for spell in list(self.spells.values()):
+                state = spell.state
+                if state is not None and state.dirty:
+                    state.dirty = False
+                    states.append(state)
+
+        for state in states:
+            try:
+                state.flush()
+
+            except Exception:
+                state.dirty = True
+                self.print_error()
 
     def update(self, force_run=False):
         try:
+            self.flush_states()
             self.read_config()
-            for id in self.caster_config.spell_configs:
-                try:
-                    if id in self.spells:
-                        continue
+            spell_configs = self.caster_config.spell_configs
+            for id in self.spells.keys() - spell_configs.keys():
+                # Queued runs are kept too, so that their state is still
+                # flushed and a re-added file can't run the command twice.
+                spell = self.spells[id]
+                if not spell.is_running() and not spell.is_pending():
+                    # A run may have finished since the flush above. The
+                    # spell is removed even if its state can't be written,
+                    # e.g. because its directory is gone.
+                    if spell.state is not None and spell.state.dirty:
+                        try:
+                            spell.state.flush()
 
-                    self.spells[id] = Spell(
-                        self.caster_config.spell_configs[id], self)
+                        except Exception:
+                            self.print_error()
 
-                except Exception:
-                    self.print_error()
+                    del self.spells[id]
 
-            for id in list(self.spells.keys()):
-                spell = self.spells[id]
+            for id, spell_config in spell_configs.items():
                 try:
-                    if spell.is_running():
+                    spell = self.spells.get(id)
+                    if spell is None:
+                        spell = Spell(spell_config, self)
+                        self.spells[id] = spell
+                        # Due right away, so the state is only read when the
+                        # due spells are checked below.
+                        self.schedule_spell(spell, steady_time())
+
+                    elif spell.is_running():
                         continue
 
-                    if id not in self.caster_config.spell_configs:
-                        del self.spells[id]
-
                     else:
-                        spell.set_config(self.caster_config.spell_configs[id])
+                        spell.set_config(spell_config)
+
+                    if force_run:
                         spell.update(force_run)
 
                 except Exception:
                     self.print_error()
 
+            if not force_run:
+                self.run_due_spells()
+
         except Exception:
             self.print_error()
 
+    def get_run_semaphore(self):
+        # Only called on the event loop, so creating it lazily binds it to
+        # that loop.
+        if self.run_semaphore is None:
+            self.run_semaphore = asyncio.Semaphore(self.max_running_spells)
+
+        return self.run_semaphore
+
+    def schedule_spell(self, spell, due_time=None):
+        if due_time is None:
+            due_time = spell.get_due_time()
+
+        with self.due_lock:
+            spell.due_time = due_time
+            heapq.heappush(self.due_heap, (due_time, spell.config.config_path))
+
+    def run_due_spells(self):
+        now = steady_time()
+        due = []
+        with self.due_lock:
+            while self.due_heap and self.due_heap[0][0] <= now:
+                due.append(heapq.heappop(self.due_heap))
+
+        for due_time, id in due:
+            spell = self.spells.get(id)
+            if spell is None or spell.due_time != due_time:
+                continue
+
+            try:
+                spell.update()
+                # A started run reschedules the spell when it is done.
+                if not spell.is_pending():
+                    self.schedule_spell(spell)
+
+            except Exception:
+                self.print_error()
+                # The due check failed, e.g. on an unreadable state file, so
+                # it is retried after the spell's interval.
+                self.schedule_spell(
+                    spell, steady_time() + spell.interval_seconds)
+
     def handle_request(self, request):
         try:
-            request = json.loads(request)
+            # Given as raw bytes, so that undecodable input only fails this
+            # request.
+            request = json_loads(request)
             action = request['action']
             if action == 'cast':
                 id = request['spell_id']
@@ -398,16 +901,136 @@ class Caster(object):
             self.print_error()
 
     def start(self):
-        self.update()
-        self.timer.start()
-        while True:
-            request = str(input())
-            self.handle_request(request)
+        # Updates and state flushes run on this thread, between requests.
+        # Stdin is read from the raw fd, since a buffered readline could
+        # hold complete lines the selector doesn't know about.
+        stdin_fd = sys.stdin.fileno()
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(stdin_fd, selectors.EVENT_READ)
+            stdin_polled = True
+
+        except PermissionError:
+            # Regular files and /dev/null can't be polled, but reading them
+            # never blocks either.
+            stdin_polled = False
+
+        stdin_open = True
+        pending = b''
+
+        now = steady_time()
+        next_update = now
+        next_flush = now + STATE_FLUSH_INTERVAL
+        try:
+            while True:
+                now = steady_time()
+                if now >= next_update:
+                    next_update = now + self.update_interval
+                    self.update()
+
+                if now >= next_flush:
+                    next_flush = now + STATE_FLUSH_INTERVAL
+                    self.flush_states()
+
+                timeout = max(min(next_update, next_flush) - steady_time(),
+                              0)
+                if not stdin_open:
+                    # Spells keep being cast once there are no more requests.
+                    time.sleep(timeout)
+                    continue
+
+                if stdin_polled and not selector.select(timeout):
+                    continue
+
+                data = os.read(stdin_fd, STDIN_READ_SIZE)
+                if not data:
+                    if pending:
+                        self.handle_request(pending)
+
+                    stdin_open = False
+                    if stdin_polled:
+                        selector.unregister(stdin_fd)
+
+                    continue
+
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    self.handle_request(line)
+
+        finally:
+            selector.close()
+            self.stop()
+
+    def stop(self):
+        # Give started runs a moment to finish so that their results are
+        # saved. Spells lead their own sessions and don't get the terminal's
+        # SIGINT, so the ones still running after that are killed.
+        self.stopping = True
+        spells = list(self.spells.values())
+        futures = [spell.future for spell in spells if spell.is_pending()]
+        _, not_done = concurrent.futures.wait(futures, timeout=STOP_TIMEOUT)
+        if not_done:
+            for spell in spells:
+                try:
+                    spell.kill()
+
+                except RuntimeError:
+                    pass
+
+            concurrent.futures.wait(not_done, timeout=STOP_TIMEOUT)
+
+        self.flush_states()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.print_queue.put(None)
+        self.print_thread.join()
 
     def print(self, message):
-        self.print_lock.acquire()
-        print(message)
-        self.print_lock.release()
+        self.print_queue.put(message)
+
+    def print_worker(self):
+        # Drains everything queued so far into one write and one flush.
+        # Queued dicts are update notifications. None stops the worker once
+        # the messages before it are written.
+        while True:
+            messages = [self.print_queue.get()]
+            try:
+                while True:
+                    messages.append(self.print_queue.get_nowait())
+
+            except queue.Empty:
+                pass
+
+            stopped = None in messages
+            if stopped:
+                messages = messages[:messages.index(None)]
+
+            # Errors are reported rather than raised, since the worker must
+            # outlive them for later messages to be printed at all.
+            if messages:
+                lines = []
+                for message in messages:
+                    try:
+                        if not isinstance(message, str):
+                            message = '@update: ' + \
+                                json_dumps(message).decode('utf-8')
+
+                        lines.append(message)
+
+                    except Exception:
+                        lines.append(get_traceback())
+
+                lines.append('')
+                try:
+                    sys.stdout.write('\n'.join(lines))
+                    sys.stdout.flush()
+
+                except Exception:
+                    sys.stderr.write(get_traceback())
+
+            if stopped:
+                return
 
     def print_error(self):
         self.print(get_traceback())
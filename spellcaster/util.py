@@ -1,6 +1,97 @@
-from threading import Timer
+import json
+import platform
+import time
 import traceback
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def json_loads(data):
+    '''
+    Parse JSON from bytes (or str), using orjson or ujson when available.
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+
+    if ujson is not None:
+        return ujson.loads(data)
+
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=False, newline=False):
+    '''
+    Serialize obj to JSON bytes, using orjson or ujson when available.
+    '''
+    data = None
+    if orjson is not None:
+        option = 0
+        if indent:
+            option |= orjson.OPT_INDENT_2
+
+        if newline:
+            option |= orjson.OPT_APPEND_NEWLINE
+
+        try:
+            return orjson.dumps(obj, option=option)
+
+        except TypeError:
+            pass
+
+    elif ujson is not None:
+        try:
+            data = ujson.dumps(obj, indent=2 if indent else 0,
+                               escape_forward_slashes=False)
+
+        except (TypeError, UnicodeEncodeError):
+            pass
+
+    if data is None:
+        # orjson and ujson reject strings that aren't valid UTF-8, such as
+        # file names decoded with surrogate escapes. Escaped to ASCII, the
+        # stdlib can still write them.
+        data = json.dumps(obj, indent=2 if indent else None,
+                          ensure_ascii=True)
+
+    if newline:
+        data += '\n'
+
+    return data.encode('utf-8')
+
+
+# time.monotonic doesn't advance while the machine is suspended. These
+# clocks do, so that intervals include time spent asleep.
+if hasattr(time, 'CLOCK_BOOTTIME'):
+    STEADY_CLOCK = time.CLOCK_BOOTTIME
+elif platform.system() == 'Darwin':
+    STEADY_CLOCK = time.CLOCK_MONOTONIC
+else:
+    STEADY_CLOCK = None
+
+
+def steady_time():
+    '''
+    Return seconds on a monotonic clock that keeps counting during suspend,
+    where the platform has one.
+    '''
+    if STEADY_CLOCK is not None:
+        return time.clock_gettime(STEADY_CLOCK)
+
+    return time.monotonic()
+
 
 def get_traceback():
     '''
@@ -9,30 +100,31 @@ def get_traceback():
     return traceback.format_exc()
 
 
-class RepeatedTimer(object):
-    """
-    Reference: https://stackoverflow.com/a/38317060
-    """
-
-    def __init__(self, interval, function, *args, **kwargs):
-        self._timer = None
-        self.interval = interval
-        self.function = function
-        self.args = args
-        self.kwargs = kwargs
-        self.is_waiting = False
-
-    def _run(self):
-        self.is_waiting = False
-        self.start()
-        self.function(*self.args, **self.kwargs)
-
-    def start(self):
-        if not self.is_waiting:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_waiting = True
-
-    def stop(self):
-        self._timer.cancel()
-        self.is_waiting = False
+def hash_bytes(data):
+    '''
+    Return a fast non-cryptographic hash of data, using xxhash when
+    available. Only meant for change detection within one process.
+    '''
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+
+    return hash(data)
+
+
+async def read_bounded(stream, limit, chunk_size=8192):
+    '''
+    Read an asyncio stream until EOF, returning at most the first limit
+    bytes.
+    '''
+    chunks = []
+    size = 0
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+
+        if size < limit:
+            chunks.append(chunk[:limit - size])
+            size += len(chunks[-1])
+
+    return b''.join(chunks)